@@ -1,6 +1,5 @@
 import os
 import json
-import requests
 from io import BytesIO
 from urllib.parse import urlparse
 from multiprocessing.pool import ThreadPool
@@ -8,7 +7,7 @@ from multiprocessing.pool import ThreadPool
 import boto3
 from tqdm import tqdm
 
-from .utils import load_image_from_url, load_label_bitmap_from_url, handle_exif_rotation
+from .utils import load_image_from_url, load_label_bitmap_from_url, load_release, handle_exif_rotation
 
 from PIL import Image
 
@@ -45,9 +44,8 @@ class SegmentsDataset():
             with open(release_file) as f:
                 self.release = json.load(f)
         else: # If it's a release object
+            self.release = load_release(release_file)
             release_file = release_file['attributes']['url']
-            content = requests.get(release_file)
-            self.release = json.loads(content.content)        
         self.release_file = release_file
 
         self.dataset_identifier = '{}_{}'.format(self.release['dataset']['owner'], self.release['dataset']['name'])
@@ -5,15 +5,19 @@ import json
 import random
 
 from tqdm import tqdm
+from contextlib import contextmanager
 from shutil import copyfile
+from threading import Condition
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 
 from PIL import Image
+from scipy.ndimage import find_objects
 from skimage import img_as_ubyte
-from skimage.measure import regionprops
+from skimage.measure import regionprops_table
 
-from .utils import get_semantic_bitmap
+from .utils import get_semantic_bitmap, njit, orjson
 
 COLORMAP = [[0, 113, 188, 255], [216, 82, 24, 255], [236, 176, 31, 255], [125, 46, 141, 255], [118, 171, 47, 255], [76, 189, 237, 255], [161, 19, 46, 255], [255, 0, 0, 255], [255, 127, 0, 255], [190, 190, 0, 255], [0, 255, 0, 255], [0, 0, 255, 255], [170, 0, 255, 255], [84, 84, 0, 255], [84, 170, 0, 255], [84, 255, 0, 255], [170, 84, 0, 255], [170, 170, 0, 255], [170, 255, 0, 255], [255, 84, 0, 255], [255, 170, 0, 255], [255, 255, 0, 255], [0, 84, 127, 255], [0, 170, 127, 255], [0, 255, 127, 255], [84, 0, 127, 255], [84, 84, 127, 255], [84, 170, 127, 255], [84, 255, 127, 255], [170, 0, 127, 255], [170, 84, 127, 255], [170, 170, 127, 255], [170, 255, 127, 255], [255, 0, 127, 255], [255, 84, 127, 255], [255, 170, 127, 255]]
 
@@ -29,65 +33,117 @@ class IdGenerator():
     'isthing' and 'color'
     '''
     def __init__(self, categories):
-        self.taken_colors = set([0, 0, 0])
+        # Colors are stored packed into a single int, using the same encoding as rgb2id.
+        self.taken_colors = set([rgb2id([0, 0, 0])])
         self.categories = categories
-        for category in self.categories.values():
+        # Stuff categories always get the same id and color, so they are computed only once.
+        self.stuff_ids_and_colors = {}
+        for cat_id, category in self.categories.items():
             if category['isthing'] == 0:
-                self.taken_colors.add(tuple(category['color']))
+                self.taken_colors.add(rgb2id(category['color']))
+                self.stuff_ids_and_colors[cat_id] = rgb2id(category['color']), category['color']
 
     def get_color(self, cat_id):
-        def random_color(base, max_dist=30):
-            new_color = base + np.random.randint(low=-max_dist,
-                                                 high=max_dist+1,
-                                                 size=3)
-            return tuple(np.maximum(0, np.minimum(255, new_color)))
+        def random_colors(base, max_dist=30, num_colors=64):
+            new_colors = base + np.random.randint(low=-max_dist,
+                                                  high=max_dist+1,
+                                                  size=(num_colors, 3))
+            return np.clip(new_colors, 0, 255)
 
         category = self.categories[cat_id]
         if category['isthing'] == 0:
             return category['color']
         base_color_array = category['color']
         base_color = tuple(base_color_array)
-        if base_color not in self.taken_colors:
-            self.taken_colors.add(base_color)
+        if rgb2id(base_color) not in self.taken_colors:
+            self.taken_colors.add(rgb2id(base_color))
             return base_color
         else:
             while True:
-                color = random_color(base_color_array)
-                if color not in self.taken_colors:
-                    self.taken_colors.add(color)
-                    return color
+                # Sample a batch of candidates at once, in most cases the first one is not taken yet.
+                colors = random_colors(base_color_array)
+                for color, packed_color in zip(colors.tolist(), rgb2id(colors[None])[0].tolist()):
+                    if packed_color not in self.taken_colors:
+                        self.taken_colors.add(packed_color)
+                        return tuple(color)
 
     def get_id(self, cat_id):
         color = self.get_color(cat_id)
         return rgb2id(color)
 
     def get_id_and_color(self, cat_id):
+        if cat_id in self.stuff_ids_and_colors:
+            return self.stuff_ids_and_colors[cat_id]
         color = self.get_color(cat_id)
         return rgb2id(color), color
 
 
+if njit is not None:
+    @njit(nogil=True, cache=True)
+    def _rgb2id_image(color):
+        id_map = np.empty(color.shape[:2], np.uint32)
+        for y in range(color.shape[0]):
+            for x in range(color.shape[1]):
+                id_map[y, x] = np.uint32(color[y, x, 0]) | (np.uint32(color[y, x, 1]) << 8) | (np.uint32(color[y, x, 2]) << 16)
+        return id_map
+
+    @njit(nogil=True, cache=True)
+    def _id2rgb_image(id_map):
+        rgb_map = np.empty((id_map.shape[0], id_map.shape[1], 3), np.uint8)
+        for y in range(id_map.shape[0]):
+            for x in range(id_map.shape[1]):
+                rgb_map[y, x, 0] = id_map[y, x] & 0xFF
+                rgb_map[y, x, 1] = (id_map[y, x] >> 8) & 0xFF
+                rgb_map[y, x, 2] = (id_map[y, x] >> 16) & 0xFF
+        return rgb_map
+
+
 def rgb2id(color):
     if isinstance(color, np.ndarray) and len(color.shape) == 3:
-        if color.dtype == np.uint8:
-            color = color.astype(np.int32)
-        return color[:, :, 0] + 256 * color[:, :, 1] + 256 * 256 * color[:, :, 2]
-    return int(color[0] + 256 * color[1] + 256 * 256 * color[2])
+        if njit is not None and np.issubdtype(color.dtype, np.integer):
+            return _rgb2id_image(color)
+        color = color.astype(np.uint32, copy=False)
+        id_map = color[:, :, 2] << 16
+        id_map |= color[:, :, 1] << 8
+        id_map |= color[:, :, 0]
+        return id_map
+    return int(color[0]) | (int(color[1]) << 8) | (int(color[2]) << 16)
 
 
 def id2rgb(id_map):
     if isinstance(id_map, np.ndarray):
-        id_map_copy = id_map.copy()
-        rgb_shape = tuple(list(id_map.shape) + [3])
-        rgb_map = np.zeros(rgb_shape, dtype=np.uint8)
-        for i in range(3):
-            rgb_map[..., i] = id_map_copy % 256
-            id_map_copy //= 256
+        if njit is not None and len(id_map.shape) == 2 and np.issubdtype(id_map.dtype, np.integer):
+            return _id2rgb_image(id_map)
+        id_map = id_map.astype(np.uint32, copy=False)
+        rgb_map = np.empty((*id_map.shape, 3), dtype=np.uint8)
+        rgb_map[..., 0] = id_map & 0xFF
+        rgb_map[..., 1] = (id_map >> 8) & 0xFF
+        rgb_map[..., 2] = (id_map >> 16) & 0xFF
         return rgb_map
-    color = []
-    for _ in range(3):
-        color.append(id_map % 256)
-        id_map //= 256
-    return color
+    id_map = int(id_map)
+    return [id_map & 0xFF, (id_map >> 8) & 0xFF, (id_map >> 16) & 0xFF]
+
+
+def json_dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj).encode('utf-8')
+
+@contextmanager
+def open_export_file(file_name):
+    '''
+    Opens a temporary file next to file_name for writing bytes. It is moved to file_name once it
+    is written completely, and removed when writing fails, so no truncated file is left behind.
+    '''
+    tmp_file_name = file_name + '.tmp'
+    try:
+        with open(tmp_file_name, 'wb') as f:
+            yield f
+    except BaseException:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+        raise
+    os.replace(tmp_file_name, file_name)
 
     
 def get_color(id):
@@ -95,25 +151,50 @@ def get_color(id):
     return COLORMAP[id][0:3]
 
 def colorize(img, colormap=None):
-    indices = np.unique(img)
+    indices = np.flatnonzero(np.bincount(img.ravel()))
     indices = indices[indices != 0]
 
-    colored_img = np.zeros((img.shape[0], img.shape[1], 3), np.uint8)
+    # Build a lookup table from label id to color, so the image is colored in a single pass.
+    lut = np.zeros((int(img.max(initial=0)) + 1, 3), np.uint8)
+    if colormap is not None:
+        lut[indices] = np.array([colormap[id-1][:3] for id in indices], np.uint8).reshape(-1, 3)
+    else:
+        colors = np.array(COLORMAP, np.uint8)[:, :3]
+        lut[indices] = colors[(indices-1) % len(colors)]
 
-    for id in indices:
-        mask = img == id
-        if colormap is not None:
-            color = colormap[id-1]
-        else:
-            color = get_color(id-1)
-        colored_img[mask] = color
+    colored_img = lut[img]
 
     return colored_img
 
+def get_label_map(segmentation_bitmap):
+    '''
+    Returns a segmentation bitmap (a PIL image or a numpy array) as a np.uint32 array.
+    32-bit PIL images are reinterpreted as np.uint32 instead of being converted a second time.
+    The result can share memory with the input, so it should not be modified.
+    '''
+    if isinstance(segmentation_bitmap, Image.Image) and segmentation_bitmap.mode == 'I':
+        return np.asarray(segmentation_bitmap).view(np.uint32)
+    return np.asarray(segmentation_bitmap, np.uint32)
+
+def get_bboxes_and_areas(label_map):
+    '''
+    Returns the bounding boxes (y0, x0, y1, x1) and pixel counts of all labels in
+    a label map, as arrays indexed by label id. Labels without pixels have area 0.
+    '''
+    # https://docs.scipy.org/doc/scipy/reference/generated/scipy.ndimage.find_objects.html
+    slices = find_objects(label_map)
+    bboxes = np.zeros((len(slices) + 1, 4), np.int64)
+    for label, label_slice in enumerate(slices, 1):
+        if label_slice is not None:
+            bboxes[label] = label_slice[0].start, label_slice[1].start, label_slice[0].stop, label_slice[1].stop
+    areas = np.bincount(label_map.ravel(), minlength=len(bboxes))
+    return bboxes, areas
+
 def get_bbox(binary_mask):
-    regions = regionprops(np.uint8(binary_mask))
-    if len(regions) == 1:
-        bbox = regions[0].bbox
+    # regionprops_table returns plain arrays, without building a region object per label.
+    regions = regionprops_table(np.uint8(binary_mask), properties=('bbox',))
+    if len(regions['bbox-0']) == 1:
+        bbox = tuple(int(regions['bbox-{}'.format(i)][0]) for i in range(4))
         return bbox
     else:
         return False
@@ -154,64 +235,69 @@ def export_coco_instance(dataset, export_folder, **kwargs):
     #     })
 
     images = []
-    annotations = []
 
-    annotation_id = 1
-    for i in tqdm(range(len(dataset))):        
+    # Samples are independent, so they are processed in parallel.
+    def _export_sample(i):
         sample = dataset[i]
 
         if sample['annotations'] is None:
-            continue
+            return None
         
+        segmentation_bitmap = get_label_map(sample['segmentation_bitmap'])
+        width, height = sample['image'].size if sample['image'] is not None else (None, None)
+
         image_id = i+1
-        images.append({        
+        image = {
             'id': image_id,
             # 'license': 1,
             'file_name': sample['file_name'],
-            'height': sample['image'].size[1] if sample['image'] is not None else None,
-            'width': sample['image'].size[0] if sample['image'] is not None else None,
+            'height': height,
+            'width': width,
     #         'date_captured': "2013-11-14 17:02:52",
     #         'coco_url': "http://images.cocodataset.org/val2017/000000397133.jpg",
     #         'flickr_url': "http://farm7.staticflickr.com/6116/6255196340_da26cf2c9e_z.jpg",        
-        })
+        }
+
+        bboxes, areas = get_bboxes_and_areas(segmentation_bitmap)
 
-        # https://scikit-image.org/docs/dev/api/skimage.measure.html#skimage.measure.regionprops
-        regions = regionprops(np.array(sample['segmentation_bitmap'], np.uint32))
-        regions = {region.label: region for region in regions}
+        # A single instance mask buffer is reused for all instances of the sample, in the (H, W, 1) Fortran layout pycocotools expects.
+        instance_mask = np.zeros((*segmentation_bitmap.shape, 1), dtype=np.uint8, order='F')
+        sample_annotations = []
         
         for instance in sample['annotations']:
             category_id = instance['category_id']
 
             annotation = {
-                'id': annotation_id,
+                'id': None, # Assigned after all samples are processed, to keep the ids sequential
                 'image_id': image_id,
                 'category_id': category_id,
             }
 
             # Segmentation bitmap
             if task_type == 'segmentation-bitmap' or task_type == 'segmentation-bitmap-highres':
-                if instance['id'] not in regions:
+                if not 0 < instance['id'] < len(areas) or areas[instance['id']] == 0:
                     # Only happens when the instance has 0 labeled pixels, which should not happen.
                     print(f'Skipping instance with 0 labeled pixels: {sample["file_name"]}, instance_id: {instance["id"]}, category_id: {category_id}')
                     continue
 
-                instance_mask = np.array(sample['segmentation_bitmap'], np.uint32) == instance['id']
-
-                region = regions[instance['id']]
-                bbox = region.bbox
                 # bbox = get_bbox(instance_mask)
                     
-                y0, x0, y1, x1 = bbox
-                # rle = mask.encode(np.asfortranarray(instance_mask))
-                rle = pctmask.encode(np.array(instance_mask[:,:,None], dtype=np.uint8, order='F'))[0] # https://github.com/matterport/Mask_RCNN/issues/387#issuecomment-522671380
+                y0, x0, y1, x1 = bboxes[instance['id']].tolist()
+                instance_slice = (slice(y0, y1), slice(x0, x1))
+
+                # Only compare the pixels inside the bounding box, the rest of the mask stays zero.
+                instance_mask[instance_slice + (0,)] = segmentation_bitmap[instance_slice] == instance['id']
+                rle = pctmask.encode(instance_mask)[0] # https://github.com/matterport/Mask_RCNN/issues/387#issuecomment-522671380
+                rle['counts'] = rle['counts'].decode('ascii')
+                # Only the bounding box was written, so only that needs to be cleared before the buffer is reused.
+                instance_mask[instance_slice + (0,)] = 0
         #         instance_mask_crop = instance_mask[y0:y1, x0:x1]
         #         rle = mask.encode(np.asfortranarray(instance_mask_crop))
         #         plt.imshow(instance_mask_crop)
         #         plt.show()
                 
                 # area = int(mask.area(rle))
-                area = int(region.area)
-                rle['counts'] = rle['counts'].decode('ascii')
+                area = int(areas[instance['id']])
 
                 annotation.update({
                     'bbox': [x0, y0, x1-x0, y1-y0],
@@ -236,21 +322,29 @@ def export_coco_instance(dataset, export_folder, **kwargs):
             else:
                 assert False
 
-            annotations.append(annotation)
-            annotation_id += 1
-            
-    json_data = {
-        'info': info,
-        # 'licenses': licenses,
-        'categories': categories,
-        'images': images,
-        'annotations': annotations    
-    #     'segment_info': [] # Only in Panoptic annotations
-    }
+            sample_annotations.append(annotation)
+
+        return image, sample_annotations
 
+    # The annotations are written to the file as soon as a sample is processed, instead of collecting them all in memory first.
+    # The images are small, so they are collected and written at the end.
     file_name = os.path.join(export_folder, 'export_coco-instance_{}_{}.json'.format(dataset.dataset_identifier, dataset.release['name']))
-    with open(file_name, 'w') as f:
-        json.dump(json_data, f)
+    with open_export_file(file_name) as f, ThreadPool(16) as pool:
+        f.write(b'{"info": ' + json_dumps(info) + b', "categories": ' + json_dumps(categories) + b', "annotations": [')
+
+        annotation_id = 1
+        for result in tqdm(pool.imap(_export_sample, range(len(dataset))), total=len(dataset)):
+            if result is None:
+                continue
+
+            image, sample_annotations = result
+            images.append(image)
+            for annotation in sample_annotations:
+                annotation['id'] = annotation_id
+                f.write((b', ' if annotation_id > 1 else b'') + json_dumps(annotation))
+                annotation_id += 1
+
+        f.write(b'], "images": ' + json_dumps(images) + b'}')
 
     print('Exported to {}. Images and labels in {}'.format(file_name, dataset.image_dir))
     return file_name, dataset.image_dir
@@ -288,53 +382,72 @@ def export_coco_panoptic(dataset, export_folder, **kwargs):
         
     # IMAGES AND ANNOTATIONS
     images = []
-    annotations = []
-    for i in tqdm(range(len(dataset))):
-        sample = dataset[i]
+
+    # The id generator is shared between the threads. The samples take turns drawing from it in dataset order,
+    # so the ids and colors are the same as in a sequential export, however the threads are scheduled.
+    id_generator_turn = Condition()
+    next_sample_index = 0
+
+    def _get_ids_and_colors(i, annotations):
+        nonlocal next_sample_index
+        with id_generator_turn:
+            id_generator_turn.wait_for(lambda: next_sample_index == i)
+            try:
+                if annotations is None:
+                    return None
+                return [id_generator.get_id_and_color(instance['category_id']) for instance in annotations]
+            finally:
+                next_sample_index += 1
+                id_generator_turn.notify_all()
+
+    # Samples are independent, so they are processed in parallel.
+    def _export_sample(i):
+        sample = None
+        try:
+            sample = dataset[i]
+        finally:
+            # The turn is also passed on when loading the sample failed, so the other threads don't wait forever.
+            ids_and_colors = _get_ids_and_colors(i, sample['annotations'] if sample is not None else None)
 
         if sample['annotations'] is None:
-            continue
+            return None
         
+        segmentation_bitmap = get_label_map(sample['segmentation_bitmap'])
+        width, height = sample['image'].size if sample['image'] is not None else (None, None)
+
         # Images
         image_id = i+1
-        images.append({        
+        image = {
             'id': image_id,
             'file_name': sample['file_name'],
-            'height': sample['image'].size[1] if sample['image'] is not None else None,
-            'width': sample['image'].size[0] if sample['image'] is not None else None,
-        })
+            'height': height,
+            'width': width,
+        }
         
         # Annotations
-        panoptic_label = np.zeros((sample['segmentation_bitmap'].size[1], sample['segmentation_bitmap'].size[0], 3), np.uint8)
-        
         segments_info = []
 
-        # https://scikit-image.org/docs/dev/api/skimage.measure.html#skimage.measure.regionprops
-        regions = regionprops(np.array(sample['segmentation_bitmap'], np.uint32))
-        regions = {region.label: region for region in regions}
+        bboxes, areas = get_bboxes_and_areas(segmentation_bitmap)
 
-        for instance in sample['annotations']:
+        # Lookup table from instance id to panoptic color, applied to the whole bitmap at once after the loop.
+        colors = np.zeros((int(segmentation_bitmap.max(initial=0)) + 1, 3), np.uint8)
+
+        for instance, (instance_id, color) in zip(sample['annotations'], ids_and_colors):
             category_id = instance['category_id']
-                
-            instance_id, color = id_generator.get_id_and_color(category_id)
 
-            if instance['id'] not in regions:
+            if not 0 < instance['id'] < len(areas) or areas[instance['id']] == 0:
                 # Only happens when the instance has 0 labeled pixels, which should not happen.
                 print(f'Skipping instance with 0 labeled pixels: {sample["file_name"]}, instance_id: {instance["id"]}, category_id: {category_id}')
                 continue
-            
-            # Read the instance mask and fill in the panoptic label. TODO: take this out of the loop to speed things up.
-            instance_mask = np.array(sample['segmentation_bitmap'], np.uint32) == instance['id']
-            panoptic_label[instance_mask] = color
+
+            colors[instance['id']] = color
 
             # bbox = get_bbox(instance_mask)
-            region = regions[instance['id']]
-            bbox = region.bbox
-            y0, x0, y1, x1 = bbox
+            y0, x0, y1, x1 = bboxes[instance['id']].tolist()
 
             # rle = mask.encode(np.array(instance_mask[:,:,None], dtype=np.uint8, order='F'))[0] # https://github.com/matterport/Mask_RCNN/issues/387#issuecomment-522671380
             # area = int(mask.area(rle))
-            area = int(region.area)
+            area = int(areas[instance['id']])
 
             segments_info.append({
                 'id': instance_id,
@@ -343,14 +456,16 @@ def export_coco_panoptic(dataset, export_folder, **kwargs):
                 'area': area,
                 'iscrowd': 0
             })
+
+        panoptic_label = colors[segmentation_bitmap]
             
         file_name = os.path.splitext(os.path.basename(sample['name']))[0]
         label_file_name = '{}_label_{}_coco-panoptic.png'.format(file_name, dataset.labelset)
-        annotations.append({
+        annotation = {
             'segments_info': segments_info,
             'file_name': label_file_name,
             'image_id': image_id,
-        })        
+        }
 
         # # Image
         # image = sample['image']
@@ -380,19 +495,24 @@ def export_coco_panoptic(dataset, export_folder, **kwargs):
         # semantic_label_colored = colorize(np.uint8(semantic_label), colormap=[c['color'] for c in categories])
         # export_file = os.path.join(dataset.image_dir, '{}_label_{}_semantic_colored.png'.format(file_name, dataset.labelset))
         # Image.fromarray(img_as_ubyte(semantic_label_colored)).save(export_file)
-    
-    # PUT EVERYTHING TOGETHER
-    json_data = {
-        'info': info,
-        'categories': categories,
-        'images': images,
-        'annotations': annotations    
-    }
+
+        return image, annotation
 
     # WRITE JSON TO FILE
+    # The annotations are written as soon as a sample is processed, the images are put together and written at the end.
     file_name = os.path.join(export_folder, 'export_coco-panoptic_{}_{}.json'.format(dataset.dataset_identifier, dataset.release['name']))
-    with open(file_name, 'w') as f:
-        json.dump(json_data, f)
+    with open_export_file(file_name) as f, ThreadPool(16) as pool:
+        f.write(b'{"info": ' + json_dumps(info) + b', "categories": ' + json_dumps(categories) + b', "annotations": [')
+
+        for result in tqdm(pool.imap(_export_sample, range(len(dataset))), total=len(dataset)):
+            if result is None:
+                continue
+
+            image, annotation = result
+            f.write((b', ' if len(images) > 0 else b'') + json_dumps(annotation))
+            images.append(image)
+
+        f.write(b'], "images": ' + json_dumps(images) + b'}')
 
     print('Exported to {}. Images and labels in {}'.format(file_name, dataset.image_dir))
     return file_name, dataset.image_dir
@@ -416,11 +536,12 @@ def export_image(dataset, export_folder, export_format, id_increment, **kwargs):
             'isthing': isthing
         })
 
-    for i in tqdm(range(len(dataset))):
+    # Samples are independent, so they are exported in parallel.
+    def _export_sample(i):
         sample = dataset[i]
 
         if sample['annotations'] is None:
-            continue
+            return
 
         file_name = os.path.splitext(os.path.basename(sample['name']))[0]
 
@@ -433,21 +554,21 @@ def export_image(dataset, export_folder, export_format, id_increment, **kwargs):
             # Instance png
             instance_label = sample['segmentation_bitmap']
             export_file = os.path.join(dataset.image_dir, '{}_label_{}_instance.png'.format(file_name, dataset.labelset))
-            instance_label.save(export_file)
+            instance_label.save(export_file, compress_level=1)
 
         elif export_format == 'instance-color':
             # Colored instance png
             instance_label = sample['segmentation_bitmap']
             instance_label_colored = colorize(np.uint8(instance_label))
             export_file = os.path.join(dataset.image_dir, '{}_label_{}_instance_colored.png'.format(file_name, dataset.labelset))
-            Image.fromarray(img_as_ubyte(instance_label_colored)).save(export_file)
+            Image.fromarray(instance_label_colored).save(export_file, compress_level=1)
 
         elif export_format == 'semantic':
             # Semantic png
             instance_label = sample['segmentation_bitmap']
             semantic_label = get_semantic_bitmap(instance_label, sample['annotations'], id_increment)
             export_file = os.path.join(dataset.image_dir, '{}_label_{}_semantic.png'.format(file_name, dataset.labelset))
-            Image.fromarray(img_as_ubyte(semantic_label)).save(export_file)
+            Image.fromarray(img_as_ubyte(semantic_label)).save(export_file, compress_level=1)
 
         elif export_format == 'semantic-color':
             # Colored semantic png
@@ -455,31 +576,32 @@ def export_image(dataset, export_folder, export_format, id_increment, **kwargs):
             semantic_label = get_semantic_bitmap(instance_label, sample['annotations'], id_increment)
             semantic_label_colored = colorize(np.uint8(semantic_label), colormap=[c['color'] for c in categories])
             export_file = os.path.join(dataset.image_dir, '{}_label_{}_semantic_colored.png'.format(file_name, dataset.labelset))
-            Image.fromarray(img_as_ubyte(semantic_label_colored)).save(export_file)
+            Image.fromarray(semantic_label_colored).save(export_file, compress_level=1)
+
+    with ThreadPool(16) as pool:
+        list(tqdm(pool.imap_unordered(_export_sample, range(len(dataset))), total=len(dataset)))
 
     print('Exported to {}'.format(dataset.image_dir))
     return dataset.image_dir
 
 def write_yolo_file(file_name, annotations, image_width, image_height):
+    bbox_annotations = [annotation for annotation in annotations if annotation['type'] == 'bbox']
+    category_ids = [annotation['category_id'] for annotation in bbox_annotations]
+    points = np.array([annotation['points'] for annotation in bbox_annotations], dtype=np.float64).reshape(-1, 4)
+
+    # Normalize
+    x0, y0, x1, y1 = (points / [image_width, image_height, image_width, image_height]).T
+
+    # Get center, width and height of all bboxes at once
+    x_center = (x0 + x1) / 2
+    y_center = (y0 + y1) / 2
+    width = np.abs(x1 - x0)
+    height = np.abs(y1 - y0)
+
+    # Save them to the file with a single write
+    lines = [f'{category_id} {xc:.6f} {yc:.6f} {w:.6f} {h:.6f}\n' for category_id, xc, yc, w, h in zip(category_ids, x_center.tolist(), y_center.tolist(), width.tolist(), height.tolist())]
     with open(file_name, 'w') as f:
-        for annotation in annotations:
-            if annotation['type'] == 'bbox':
-                category_id = annotation['category_id']
-                [[x0, y0], [x1, y1]] = annotation['points']
-
-                # Normalize
-                x0, x1 = x0 / image_width, x1 / image_width
-                y0, y1 = y0 / image_height, y1 / image_height
-
-                # Get center, width and height of bbox
-                x_center = (x0 + x1) / 2
-                y_center = (y0 + y1) / 2
-                width = abs(x1 - x0)
-                height = abs(y1 - y0)
-
-                # Save it to the file
-#                 print(category_id, x_center, y_center, width, height)
-                f.write('{} {:.6f} {:.6f} {:.6f} {:.6f}\n'.format(category_id, x_center, y_center, width, height))
+        f.write(''.join(lines))
 
 def export_yolo(dataset, export_folder, **kwargs):
     if dataset.task_type not in ['vector', 'bboxes', 'image-vector-sequence']:
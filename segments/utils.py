@@ -1,47 +1,106 @@
-import os
 from io import BytesIO
 import requests
-import urllib.request
 import json
+from functools import lru_cache
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
-from PIL import Image, ExifTags
+from PIL import Image, ImageOps, ExifTags
+
+# Optional speedups, used when installed: numba for pixelwise loops, orjson for the (large) json files,
+# pyvips or OpenCV for PNG encoding and pyspng for PNG decoding. segments.export reuses numba and orjson from here.
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+try:
+    import pyspng
+except ImportError:
+    pyspng = None
 
 session = requests.Session()
-adapter = requests.adapters.HTTPAdapter(max_retries=3)
+# The connection pool is large enough for the parallel downloads in SegmentsDataset, so connections are kept alive and reused.
+adapter = requests.adapters.HTTPAdapter(max_retries=3, pool_connections=32, pool_maxsize=32)
 session.mount('http://', adapter)
 session.mount('https://', adapter)
 
-def bitmap2file(bitmap, is_segmentation_bitmap=True):
+def bitmap2file(bitmap, is_segmentation_bitmap=True, compress_level=1):
     """Convert a label bitmap to a file with the proper format.
 
     Args:
         bitmap (np.uint32): A numpy array where each unique value represents an instance id.
+        compress_level (int, optional): The PNG compression level, from 0 (fastest) to 9 (smallest). Defaults to 1.
 
     Returns:
         object: a file object.
     """
 
-    # Convert bitmap to np.uint32, if it is not already
-    if bitmap.dtype == 'uint32':
-        pass
-    elif bitmap.dtype == 'uint8':
-        bitmap = np.uint32(bitmap)
-    else:
-        assert False
+    # Convert bitmap to np.uint32, if it is not already. uint8 bitmaps are widened by the alpha OR below.
+    if bitmap.dtype != np.uint32 and bitmap.dtype != np.uint8:
+        bitmap = bitmap.astype(np.uint32)
 
     if is_segmentation_bitmap:
-        bitmap2 = np.copy(bitmap)
-        bitmap2 = bitmap2[:, :, None].view(np.uint8)
-        bitmap2[:, :, 3] = 255
+        # Set the alpha byte of every pixel to 255 in a single pass, writing straight into a C-contiguous RGBA buffer
+        h, w = bitmap.shape
+        bitmap2 = np.empty((h, w, 4), dtype=np.uint8)
+        np.bitwise_or(bitmap, np.uint32(0xFF000000), out=bitmap2.view(np.uint32).reshape(h, w))
     else:
         assert False
         
-    f = BytesIO()
-    Image.fromarray(bitmap2).save(f, 'PNG')
-    f.seek(0)
+    if pyvips is not None:
+        image = pyvips.Image.new_from_memory(bitmap2.data, bitmap2.shape[1], bitmap2.shape[0], 4, 'uchar')
+        f = BytesIO(image.write_to_buffer('.png', compression=compress_level))
+    elif cv2 is not None:
+        # OpenCV expects the channels in BGRA order
+        _, png = cv2.imencode('.png', cv2.cvtColor(bitmap2, cv2.COLOR_RGBA2BGRA), [cv2.IMWRITE_PNG_COMPRESSION, compress_level])
+        f = BytesIO(png.tobytes())
+    else:
+        # Wrap the RGBA buffer directly, this skips the dtype and stride inference of Image.fromarray
+        image = Image.frombuffer('RGBA', (bitmap2.shape[1], bitmap2.shape[0]), bitmap2, 'raw', 'RGBA', 0, 1)
+        f = BytesIO()
+        image.save(f, 'PNG', compress_level=compress_level, optimize=False)
+        f.seek(0)
     return f
 
+def bitmap2files(bitmaps, workers=None, compress_level=1):
+    """Convert a list of label bitmaps to files in parallel.
+
+    Args:
+        bitmaps (list): A list of np.uint32 label bitmaps.
+        workers (int, optional): The number of parallel encoders. Defaults to the number of CPUs.
+        compress_level (int, optional): The PNG compression level, from 0 (fastest) to 9 (smallest). Defaults to 1.
+
+    Returns:
+        list: a list of file objects, in the same order as the bitmaps.
+    """
+    # The PNG encoders release the GIL while compressing, so the encodes run on multiple cores.
+    with ThreadPool(workers) as pool:
+        return pool.map(lambda bitmap: bitmap2file(bitmap, compress_level=compress_level), bitmaps)
+
+if njit is not None:
+    @njit(nogil=True, cache=True)
+    def _remap(bitmap, lut, out):
+        for i in range(bitmap.size):
+            if bitmap[i] >= lut.size:
+                raise IndexError('The bitmap contains an instance id that is not in the annotations.')
+            out[i] = lut[bitmap[i]]
+
 def get_semantic_bitmap(instance_bitmap, annotations, id_increment=1):
     """Convert an instance bitmap and annotations dict into a segmentation bitmap.
 
@@ -52,19 +111,55 @@ def get_semantic_bitmap(instance_bitmap, annotations, id_increment=1):
 
     Returns:
         np.uint32: a numpy array where each unique value represents a category id.
+
+    Raises:
+        ValueError: If a category id plus id_increment is negative.
     """
 
     if instance_bitmap is None or annotations is None:
         return None
 
-    instance2semantic = [0] * (max([a['id'] for a in annotations], default=0)+1)
-    for annotation in annotations:
-        instance2semantic[annotation['id']] = annotation['category_id'] + id_increment
-    instance2semantic = np.array(instance2semantic)
+    # Lookup table from instance id to category id
+    instance_ids = np.fromiter((a['id'] for a in annotations), dtype=np.int64, count=len(annotations))
+    category_ids = np.fromiter((a['category_id'] for a in annotations), dtype=np.int64, count=len(annotations))
+    semantic_ids = category_ids + id_increment
+    if semantic_ids.min(initial=0) < 0:
+        raise ValueError('The category ids plus id_increment must not be negative, they are stored as np.uint32.')
+    instance2semantic = np.zeros(int(instance_ids.max(initial=0))+1, dtype=np.uint32)
+    instance2semantic[instance_ids] = semantic_ids
         
-    semantic_label = instance2semantic[np.array(instance_bitmap, np.uint32)]
+    instance_bitmap = np.asarray(instance_bitmap, np.uint32)
+    if njit is not None:
+        semantic_label = np.empty(instance_bitmap.shape, dtype=np.uint32)
+        _remap(instance_bitmap.ravel(), instance2semantic, semantic_label.ravel())
+    else:
+        semantic_label = instance2semantic[instance_bitmap]
     return semantic_label
 
+SEGMENTATION_TASK_TYPES = ('segmentation-bitmap', 'segmentation-bitmap-highres')
+VECTOR_TASK_TYPES = ('vector', 'bboxes', 'image-vector-sequence')
+
+# The supported task types and the exporter function in segments.export of every export format
+EXPORT_FORMATS = {
+    'coco-panoptic': (SEGMENTATION_TASK_TYPES, 'export_coco_panoptic'),
+    'coco-instance': (SEGMENTATION_TASK_TYPES, 'export_coco_instance'),
+    'yolo': (VECTOR_TASK_TYPES, 'export_yolo'),
+    'semantic-color': (SEGMENTATION_TASK_TYPES, 'export_image'),
+    'instance-color': (SEGMENTATION_TASK_TYPES, 'export_image'),
+    'semantic': (SEGMENTATION_TASK_TYPES, 'export_image'),
+    'instance': (SEGMENTATION_TASK_TYPES, 'export_image'),
+}
+
+def task_types_description(task_types):
+    task_types = ['"{}"'.format(task_type) for task_type in task_types]
+    return '{} and {}'.format(', '.join(task_types[:-1]), task_types[-1])
+
+@lru_cache(maxsize=None)
+def get_exporter(exporter_name):
+    # Imported on first use only, segments.export pulls in heavy dependencies like scikit-image.
+    from . import export
+    return getattr(export, exporter_name)
+
 def export_dataset(dataset, export_folder='.', export_format='coco-panoptic', id_increment=1, **kwargs):
     """Export a dataset to a different format.
 
@@ -76,30 +171,16 @@ def export_dataset(dataset, export_folder='.', export_format='coco-panoptic', id
     """
 
     print('Exporting dataset. This may take a while...')
-    if export_format == 'coco-panoptic':
-        if not dataset.task_type in ['segmentation-bitmap', 'segmentation-bitmap-highres']:
-            raise ValueError('Only datasets of type "segmentation-bitmap" and "segmentation-bitmap-highres" can be exported to this format.')
-        from .export import export_coco_panoptic
-        return export_coco_panoptic(dataset, export_folder, **kwargs)
-    elif export_format == 'coco-instance':
-        if not dataset.task_type in ['segmentation-bitmap', 'segmentation-bitmap-highres']:
-            raise ValueError('Only datasets of type "segmentation-bitmap" and "segmentation-bitmap-highres" can be exported to this format.')
-        from .export import export_coco_instance
-        return export_coco_instance(dataset, export_folder, **kwargs)
-    elif export_format == 'yolo':
-        if not dataset.task_type in ['vector', 'bboxes', 'image-vector-sequence']:
-            raise ValueError('Only datasets of type "vector", "bboxes" and "image-vector-sequence" can be exported to this format.')
-        from .export import export_yolo
-        return export_yolo(dataset, export_folder, **kwargs)
-    elif export_format in ['semantic-color', 'instance-color', 'semantic', 'instance']:
-        if not dataset.task_type in ['segmentation-bitmap', 'segmentation-bitmap-highres']:
-            raise ValueError('Only datasets of type "segmentation-bitmap" and "segmentation-bitmap-highres" can be exported to this format.')
-        from .export import export_image
-        return export_image(dataset, export_folder, export_format, id_increment, **kwargs)
-    else:
-        print('Supported export formats: coco-panoptic, coco-instance, yolo')
+    if export_format not in EXPORT_FORMATS:
+        print('Supported export formats: {}'.format(', '.join(EXPORT_FORMATS)))
         return
 
+    task_types, exporter_name = EXPORT_FORMATS[export_format]
+    if not dataset.task_type in task_types:
+        raise ValueError('Only datasets of type {} can be exported to this format.'.format(task_types_description(task_types)))
+    exporter = get_exporter(exporter_name)
+    return exporter(dataset, export_folder, export_format=export_format, id_increment=id_increment, **kwargs)
+
 def load_image_from_url(url, save_filename=None):
     """Load an image from url.
 
@@ -110,8 +191,11 @@ def load_image_from_url(url, save_filename=None):
     Returns:
         PIL.Image: a PIL image.
     """
-    image = Image.open(BytesIO(session.get(url).content))
-    # urllib.request.urlretrieve(url, save_filename)
+    # Stream the response body into PIL. The image is loaded before the response is closed.
+    with session.get(url, stream=True) as response:
+        response.raw.decode_content = True
+        image = Image.open(response.raw)
+        image.load()
 
     if save_filename is not None:
         if 'exif' in image.info:
@@ -132,36 +216,65 @@ def load_label_bitmap_from_url(url, save_filename=None):
         np.uint32: a numpy np.uint32 array.
     """
     def extract_bitmap(bitmap):
-        bitmap = np.array(bitmap)
-        bitmap[:,:,3] = 0
-        bitmap = bitmap.view(np.uint32).squeeze(2)
+        # View the RGBA pixels as uint32 and clear the alpha byte with a single mask
+        bitmap = np.asarray(bitmap)
+        bitmap = bitmap.view(np.uint32).squeeze(2) & np.uint32(0x00FFFFFF)
         return bitmap
 
-    bitmap = Image.open(BytesIO(session.get(url).content))
-    bitmap = extract_bitmap(bitmap)
+    if pyspng is not None:
+        # pyspng decodes the PNG straight into an HxWx4 uint8 array
+        bitmap = extract_bitmap(pyspng.load(session.get(url).content))
+    else:
+        with session.get(url, stream=True) as response:
+            response.raw.decode_content = True
+            bitmap = extract_bitmap(Image.open(response.raw))
 
     if save_filename is not None:
         Image.fromarray(bitmap).save(save_filename)
 
     return bitmap
 
+def load_images_from_urls(urls, max_workers=16):
+    """Load images from a list of urls concurrently.
+
+    Args:
+        urls (list): The image urls.
+        max_workers (int, optional): The number of parallel downloads. Defaults to 16.
+
+    Returns:
+        list: a list of PIL images, in the same order as the urls.
+    """
+    # The downloads share the pooled session, which keeps up to 32 connections alive.
+    with ThreadPool(max_workers) as pool:
+        return pool.map(load_image_from_url, urls)
+
+def load_label_bitmaps_from_urls(urls, max_workers=16):
+    """Load label bitmaps from a list of urls concurrently.
+
+    Args:
+        urls (list): The label bitmap urls.
+        max_workers (int, optional): The number of parallel downloads. Defaults to 16.
+
+    Returns:
+        list: a list of np.uint32 arrays, in the same order as the urls.
+    """
+    with ThreadPool(max_workers) as pool:
+        return pool.map(load_label_bitmap_from_url, urls)
+
 def load_release(release):
     release_file = release['attributes']['url']
-    content = requests.get(release_file)
+    content = session.get(release_file)
+    if orjson is not None:
+        return orjson.loads(content.content)
     return json.loads(content.content)
 
+EXIF_ORIENTATION_TAG = next(key for key, value in ExifTags.TAGS.items() if value == 'Orientation')
+
 def handle_exif_rotation(image):
     try:
-        for orientation in ExifTags.TAGS.keys():
-            if ExifTags.TAGS[orientation]=='Orientation':
-                break
-        exif=dict(image._getexif().items())
-        if exif[orientation] == 3:
-            image=image.transpose(Image.ROTATE_180)
-        elif exif[orientation] == 6:
-            image=image.transpose(Image.ROTATE_270)
-        elif exif[orientation] == 8:
-            image=image.transpose(Image.ROTATE_90)
-        return image
-    except (AttributeError, KeyError, IndexError):
+        # exif_transpose handles all 8 orientations, but returns a copy for upright images, so skip those.
+        if image.getexif().get(EXIF_ORIENTATION_TAG, 1) == 1:
+            return image
+        return ImageOps.exif_transpose(image)
+    except Exception:
         return image
\ No newline at end of file
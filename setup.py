@@ -12,7 +12,7 @@ setup(
   url = 'https://github.com/segments-ai/segments-ai',   # Provide either the link to your github or to your website
   download_url = 'https://github.com/segments-ai/segments-ai/archive/v0.70.tar.gz',
   keywords = ['image', 'segmentation', 'labeling', 'vision'],   # Keywords that define your package best
-  install_requires = ['numpy', 'requests', 'Pillow', 'scikit-image', 'tqdm', 'boto3'],
+  install_requires = ['numpy', 'requests', 'Pillow', 'scipy', 'scikit-image', 'tqdm', 'boto3'],
   classifiers = [
     'Development Status :: 3 - Alpha',      # Chose either "3 - Alpha", "4 - Beta" or "5 - Production/Stable" as the current state of your package
     'Intended Audience :: Developers',      # Define that your audience are developers